@@ -1,2 +1,4 @@
+from .contour_set import ContourSet
 from .image_processor import DXFProcessor, SVGProcessor
+from .single_flight import SingleFlight, SingleFlightError
 from .controller import Controller
\ No newline at end of file
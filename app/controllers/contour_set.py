@@ -0,0 +1,114 @@
+import struct, numpy as np
+from functools import cached_property
+
+
+class ContourSet:
+    magic  = b'CSET'
+    header = struct.Struct('<4s4xqq')
+
+    def __init__(self, coords, offsets, closed=None):
+        self.coords  = np.asarray(coords, dtype=np.float32).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.closed  = self.get_closed() if closed is None else np.asarray(closed, dtype=bool)
+
+    @classmethod
+    def from_contours(cls, contours: list, closed=None):
+        lengths = [len(contour) for contour in contours]
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        coords  = np.concatenate(contours) if contours else np.empty((0, 2))
+        return cls(coords, offsets, closed)
+
+    def get_closed(self):
+        lengths = self.lengths
+        closed  = np.zeros(len(self), dtype=bool)
+        filled  = lengths > 1
+        starts  = self.starts[filled]
+        closed[filled] = np.all(self.coords[starts] == self.coords[starts + lengths[filled] - 1], axis=1)
+        return closed
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                coords = self.coords[self.offsets[start]:self.offsets[stop]]
+                return ContourSet(coords, self.offsets[start:stop + 1] - self.offsets[start], self.closed[start:stop])
+            key = np.arange(start, stop, step)
+        if isinstance(key, (np.ndarray, list)):
+            return self.select(key)
+        key = range(len(self))[key]
+        return self.coords[self.offsets[key]:self.offsets[key + 1]]
+
+    def select(self, key):
+        indices = np.arange(len(self))[key]
+        lengths = self.lengths[indices]
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        points  = np.repeat(self.offsets[indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return ContourSet(self.coords[points], offsets, self.closed[indices])
+
+    @property
+    def starts(self):
+        return self.offsets[:-1]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @cached_property
+    def area(self):
+        if not len(self.coords):
+            return np.zeros(len(self))
+        points    = self.coords.astype(np.float64)
+        following = np.arange(1, len(points) + 1)
+        following[self.offsets[1:] - 1] = self.starts
+        cross     = points[:, 0] * points[following, 1] - points[following, 0] * points[:, 1]
+        return 0.5 * np.abs(np.add.reduceat(cross, self.starts))
+
+    @cached_property
+    def bbox(self):
+        if not len(self.coords):
+            return np.empty((0, 4), dtype=np.float32)
+        return np.hstack((np.minimum.reduceat(self.coords, self.starts), np.maximum.reduceat(self.coords, self.starts)))
+
+    def get_bbox(self):
+        if not len(self.coords):
+            return None
+        return (*self.coords.min(axis=0), *self.coords.max(axis=0))
+
+    def transform(self, matrix):
+        matrix = np.asarray(matrix, dtype=np.float64)
+        coords = self.coords @ matrix[:2, :2].T.astype(np.float32) + matrix[:2, 2].astype(np.float32)
+        return ContourSet(coords, self.offsets, self.closed)
+
+    def to_bytes(self) -> bytes:
+        return b''.join((self.header.pack(self.magic, len(self), len(self.coords)), self.offsets.tobytes(),
+                         self.coords.tobytes(), self.closed.tobytes()))
+
+    @classmethod
+    def from_bytes(cls, buffer):
+        magic, count, points = cls.header.unpack_from(buffer)
+        if magic != cls.magic:
+            raise ValueError("Not a contour set buffer")
+        position = cls.header.size
+        offsets  = np.frombuffer(buffer, dtype=np.int64, count=count + 1, offset=position)
+        position += offsets.nbytes
+        coords   = np.frombuffer(buffer, dtype=np.float32, count=points * 2, offset=position)
+        position += coords.nbytes
+        closed   = np.frombuffer(buffer, dtype=bool, count=count, offset=position)
+        return cls(coords, offsets, closed)
+
+    def save(self, path: str) -> str:
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+        return path
+
+    @classmethod
+    def load(cls, path: str):
+        return cls.from_bytes(np.memmap(path, dtype=np.uint8, mode='r'))
@@ -1,39 +1,196 @@
-import os, subprocess, json, zipfile
+import os, subprocess, json, zipfile, cProfile, pstats, shutil, time, uuid, math
 from flask import current_app
-from . import DXFProcessor, SVGProcessor
+from werkzeug.exceptions import BadRequest
+from . import DXFProcessor, SVGProcessor, SingleFlight
 
 
 class Controller:
+    job_fields       = ('image_url', 'sku', 'obj_type', 'obj_size', 'from_svg',
+                        'resolution_x', 'resolution_y', 'image_format', 'image_quality', 'render_padding',
+                        'views', 'dxf_mode', 'dxf_precision', 'dxf_binary', 'profile',
+                        'min_area', 'min_feature')
+    image_extensions = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp'}
+    numeric_fields   = {'resolution_x':   (int, 4, 65536, 1920),
+                        'resolution_y':   (int, 4, 65536, 1080),
+                        'image_quality':  (int, 1, 100, 90),
+                        'render_padding': (float, 0, 0.5, 0.05),
+                        'dxf_precision':  (int, 0, 16, 4),
+                        'min_area':       (float, 0, math.inf, 0.02),
+                        'min_feature':    (float, 0, math.inf, 0.15)}
+    default_view     = [0, 0, 60]
+    max_views        = 36
+    geometry_version = 1
+    mesh_cache_size  = 200
+
     def __init__(self, data):
         data['cwd'] = os.path.join(os.getcwd(), "app", "static")
         self.data = data
 
     def get_archive(self):
-        self.get_dxf_and_image()
+        self.data['views'] = self.get_views()
+        for field in self.numeric_fields:
+            self.data[field] = self.get_number(field)
+        single_flight = self.get_single_flight()
+        key = single_flight.get_key(self.data, self.job_fields)
+        return single_flight.run(key, self.build_archive)
+
+    def build_archive(self):
+        if self.data.get('profile'):
+            self.profile(self.run_pipeline)
+        else:
+            self.run_pipeline()
         return self.create_archive()
 
+    def run_pipeline(self):
+        self.get_dxf_and_image()
+        if not current_app.debug:
+            self.start_blender()
+
+    def profile(self, func):
+        sku = self.data['sku']
+        self.data['blender_profile'] = self.get_blender_file(f'{sku}_blender.prof')
+        self.data['render_stats']    = self.get_blender_file(f'{sku}_render_stats.txt')
+        flask_profile                = self.get_blender_file(f'{sku}_flask.prof')
+        summary                      = self.get_blender_file(f'{sku}_profile.txt')
+        for path in (self.data['blender_profile'], self.data['render_stats']):
+            if os.path.exists(path): os.remove(path)
+
+        profiler = cProfile.Profile()
+        profiler.runcall(func)
+        profiler.dump_stats(flask_profile)
+
+        with open(summary, 'w') as f:
+            f.write("Flask\n")
+            pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(40)
+            if os.path.exists(self.data['blender_profile']):
+                f.write("Blender\n")
+                pstats.Stats(self.data['blender_profile'], stream=f).sort_stats('cumulative').print_stats(40)
+            if os.path.exists(self.data['render_stats']):
+                with open(self.data['render_stats'], 'r') as stats:
+                    f.write("Render stats\n")
+                    f.writelines(stats.readlines()[-20:])
+
+        candidates = [flask_profile, self.data['blender_profile'], self.data['render_stats'], summary]
+        self.data['profile_files'] = [path for path in candidates if os.path.exists(path)]
+
+    def get_blender_file(self, name):
+        return os.path.join(self.data['cwd'], 'blender_files', name)
+
+    def get_single_flight(self):
+        return SingleFlight(os.path.join(self.data['cwd'], 'inflight'))
+
+    def get_coalesced(self):
+        return self.get_single_flight().get_coalesced()
+
     def get_dxf_and_image(self):
-        self.data['output'] = os.path.join(self.data['cwd'], 'blender_files', f'{self.data["sku"]}.png')
-        self.data['dxf_file'] = DXFProcessor(self.data).get_dxf()
+        image_format = str(self.data.get('image_format', 'PNG')).upper()
+        self.data['image_format'] = image_format if image_format in self.image_extensions else 'PNG'
+        extension = self.image_extensions[self.data['image_format']]
+        if len(self.data['views']) == 1:
+            names = [f'{self.data["sku"]}.{extension}']
+        else:
+            names = [f'{self.data["sku"]}_{index:03d}.{extension}' for index in range(len(self.data['views']))]
+        self.data['outputs'] = [os.path.join(self.data['cwd'], 'blender_files', name) for name in names]
+        self.data['output'] = self.data['outputs'][0]
+        dxf = DXFProcessor(self.data)
+        self.data['dxf_file'] = dxf.get_dxf()
+        self.data['geometry_hash'] = f"{self.geometry_version}-{dxf.get_geometry_hash()}"
+        self.data['mesh_cache'] = self.get_mesh_cache_path(self.data['geometry_hash'])
+
+    def get_mesh_cache_path(self, geometry_hash):
+        cache_dir = os.path.join(self.data['cwd'], 'mesh_cache')
+        if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+        cache_path = os.path.join(cache_dir, f'{geometry_hash}.blend')
+        if os.path.exists(cache_path):
+            os.utime(cache_path)
+        else:
+            self.evict_mesh_cache(cache_dir)
+        return cache_path
+
+    def evict_mesh_cache(self, cache_dir):
+        entries = []
+        for name in os.listdir(cache_dir):
+            try:
+                entries.append((os.path.getmtime(os.path.join(cache_dir, name)), name))
+            except FileNotFoundError:
+                continue
+        for _, name in sorted(entries)[:max(0, len(entries) - self.mesh_cache_size + 1)]:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def get_views(self):
+        views = str(self.data.get('views') or '').strip()
+        if not views:
+            return [self.default_view]
+        try:
+            if views.startswith('turntable:'):
+                frames = int(views.split(':', 1)[1])
+                poses = [[360 * frame / frames] for frame in range(max(0, frames))]
+            else:
+                poses = json.loads(views)
+            if not isinstance(poses, list) or not 1 <= len(poses) <= self.max_views:
+                raise ValueError(views)
+            return [self.get_pose(pose) for pose in poses]
+        except (ValueError, TypeError):
+            raise BadRequest(f"'views' must be 'turntable:N' or a JSON list of [azimuth, elevation, distance] poses, "
+                             f"with 1 to {self.max_views} views")
+
+    def get_pose(self, pose):
+        if not isinstance(pose, list) or not 1 <= len(pose) <= len(self.default_view):
+            raise ValueError(pose)
+        if any(isinstance(value, bool) or not isinstance(value, (int, float)) for value in pose):
+            raise ValueError(pose)
+        pose = [float(value) for value in [*pose, *self.default_view[len(pose):]]]
+        if not all(math.isfinite(value) for value in pose) or pose[2] <= 0:
+            raise ValueError(pose)
+        return pose
+
+    def get_number(self, field):
+        kind, low, high, default = self.numeric_fields[field]
+        value = self.data.get(field)
+        try:
+            value = default if value is None or str(value).strip() == '' else kind(str(value).strip())
+        except ValueError:
+            raise BadRequest(f"'{field}' must be {'an integer' if kind is int else 'a number'}")
+        if not math.isfinite(value) or not low <= value <= high:
+            limit = f"between {low} and {high}" if math.isfinite(high) else f"at least {low}"
+            raise BadRequest(f"'{field}' must be {limit}")
+        return value
 
     def create_archive(self):
         dxf_file = self.data.get('dxf_file')
-        output   = self.data.get('output')
+        outputs  = self.data.get('outputs')
         sku      = self.data.get('sku')
 
         if current_app.debug:
-            return output
-        self.start_blender()
-        archive_dir = os.path.join(self.data.get('cwd'), 'archive')
-        if not os.path.exists(archive_dir):
-            os.makedirs(archive_dir)
+            return outputs[0]
+        archive_root = os.path.join(self.data.get('cwd'), 'archive')
+        self.cleanup_archives(archive_root)
+        archive_dir = os.path.join(archive_root, uuid.uuid4().hex)
+        os.makedirs(archive_dir)
         archive_path = os.path.join(archive_dir, f"{sku}.zip")
 
         with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
-            archive.write(dxf_file, arcname=os.path.basename(dxf_file))
-            archive.write(output, arcname=os.path.basename(output))
+            dxf_archive_file = self.data.get('dxf_archive_file', dxf_file)
+            archive.write(dxf_archive_file, arcname=os.path.basename(dxf_archive_file))
+            for output in outputs:
+                archive.write(output, arcname=os.path.basename(output))
+            for profile_file in self.data.get('profile_files', []):
+                archive.write(profile_file, arcname=os.path.basename(profile_file))
+        print(f"Archive {os.path.basename(archive_path)}: {os.path.getsize(archive_path)} bytes")
         return archive_path
 
+    def cleanup_archives(self, archive_root):
+        if not os.path.exists(archive_root):
+            return
+        expired = time.time() - self.get_single_flight().max_age
+        for name in os.listdir(archive_root):
+            path = os.path.join(archive_root, name)
+            if os.path.isdir(path) and os.path.getmtime(path) < expired:
+                shutil.rmtree(path, ignore_errors=True)
+
     def create_svg(self):
         svg = SVGProcessor(self.data)
         response = svg.get_svg_file()
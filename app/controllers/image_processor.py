@@ -1,10 +1,17 @@
-import ezdxf, os, ezdxf, requests, math, numpy as np, svgwrite
-from ezdxf.math import Matrix44
+import ezdxf, os, ezdxf, requests, math, time, hashlib, numpy as np
 from io import BytesIO
 from skimage import io, transform, filters, measure
+from .contour_set import ContourSet
 
 
 class ImageProcessor:
+    @staticmethod
+    def preload():
+        for module, name in ((io, 'imread'), (transform, 'resize'), (filters, 'gaussian'), (filters, 'threshold_otsu'),
+                             (measure, 'find_contours'), (measure, 'approximate_polygon')):
+            getattr(module, name)
+        ezdxf.new(dxfversion='R2018', units=ezdxf.units.MM)
+
     @staticmethod
     def process_image(image_url, target: str):
         response = requests.get(image_url)
@@ -17,8 +24,70 @@ class ImageProcessor:
         threshold_value = filters.threshold_otsu(img)
         binary = img > threshold_value
         contours = measure.find_contours(binary, level=0.8, fully_connected='high')
-        smoothed_contours = [measure.approximate_polygon(contour, tolerance=2.0) for contour in contours]
-        return smoothed_contours
+        smoothed_contours = [ImageProcessor.repair_contour(measure.approximate_polygon(contour, tolerance=2.0), contour) for contour in contours]
+        return ContourSet.from_contours([contour for contour in smoothed_contours if contour is not None])
+
+    @staticmethod
+    def repair_contour(simplified, original):
+        # marching squares never produces a crossing, so only the simplified rings are tested
+        for ring in (simplified, measure.approximate_polygon(original, tolerance=0.5), original):
+            ring = ring[np.concatenate(([True], np.any(np.diff(ring, axis=0) != 0, axis=1)))]
+            if len(np.unique(ring, axis=0)) < 3 or ContourSet.from_contours([ring]).area[0] == 0:
+                continue
+            if ring is original or not ImageProcessor.is_self_intersecting(ring):
+                return ring
+        return None
+
+    @staticmethod
+    def is_self_intersecting(ring, chunk: int = 1 << 18) -> bool:
+        closed = ring if np.array_equal(ring[0], ring[-1]) else np.vstack((ring, ring[:1]))
+        a, b = closed[:-1], closed[1:]
+        count = len(a)
+        lo, hi = np.minimum(a, b), np.maximum(a, b)
+
+        def orientation(p, q, r):
+            return np.sign((q[:, 0] - p[:, 0]) * (r[:, 1] - p[:, 1]) - (q[:, 1] - p[:, 1]) * (r[:, 0] - p[:, 0]))
+
+        # sweep on x: each edge is only paired with the edges whose x-range starts inside its own
+        order = np.argsort(lo[:, 0], kind='stable')
+        ends = np.searchsorted(lo[order, 0], hi[order, 0], side='right')
+        counts = ends - np.arange(count) - 1
+        totals = np.cumsum(counts)
+
+        start = 0
+        while start < count:
+            stop = max(start + 1, int(np.searchsorted(totals, totals[start] - counts[start] + chunk, side='right')))
+            rows = np.arange(start, min(stop, count))
+            first = np.repeat(rows, counts[rows])
+            second = first + 1 + np.arange(len(first)) - np.repeat(totals[rows] - counts[rows] - (totals[start] - counts[start]), counts[rows])
+            i, j = order[first], order[second]
+            gap = np.abs(i - j)
+            mask = (gap > 1) & (gap < count - 1) & (lo[i, 1] <= hi[j, 1]) & (lo[j, 1] <= hi[i, 1])
+            i, j = i[mask], j[mask]
+            d1, d2 = orientation(a[i], b[i], a[j]), orientation(a[i], b[i], b[j])
+            d3, d4 = orientation(a[j], b[j], a[i]), orientation(a[j], b[j], b[i])
+            if np.any((d1 * d2 < 0) & (d3 * d4 < 0)):
+                return True
+            start = stop
+        return False
+
+    @staticmethod
+    def get_significant(contours: ContourSet, min_area: float, min_feature: float):
+        extents = contours.bbox[:, 2:] - contours.bbox[:, :2]
+        return (contours.area >= min_area) & (extents.max(axis=1) >= min_feature)
+
+    @staticmethod
+    def get_depths(contours: ContourSet):
+        mins, maxs = contours.bbox[:, :2], contours.bbox[:, 2:]
+        probes = contours.coords[contours.starts]
+        depths = np.zeros(len(contours), dtype=int)
+
+        for index, contour in enumerate(contours):
+            candidates = np.all((probes >= mins[index]) & (probes <= maxs[index]), axis=1)
+            candidates[index] = False
+            if np.any(candidates):
+                depths[candidates] += measure.points_in_poly(probes[candidates], contour)
+        return depths
 
 class SVGProcessor:
     def __init__(self, data):
@@ -31,11 +100,11 @@ class SVGProcessor:
         svg_file_path = self.save_svg(svg_content)
         return svg_file_path
 
-    def create_svg(self, contours):
-        dwg = svgwrite.Drawing()
+    def create_svg(self, contours: ContourSet):
+        import svgwrite
+        dwg = svgwrite.Drawing(debug=False)
         for contour in contours:
-            points = [(x, y) for x, y in contour]
-            dwg.add(dwg.polyline(points, stroke='black', fill='none'))
+            dwg.add(dwg.polyline(contour, stroke='black', fill='none'))
         return dwg
 
     def save_svg(self, svg_content):
@@ -45,6 +114,10 @@ class SVGProcessor:
 
 
 class DXFProcessor:
+    compact_header = ('$ACADVER', '$DWGCODEPAGE', '$HANDSEED', '$INSUNITS', '$MEASUREMENT')
+    compact_tables = {'linetypes': ('ByBlock', 'ByLayer', 'Continuous'), 'styles': ('Standard',),
+                      'dimstyles': ('Standard',), 'appids': ('ACAD',)}
+
     def __init__(self, data: dict):
         self.doc       = ezdxf.new(dxfversion='R2018', units=ezdxf.units.MM)
         self.msp       = self.doc.modelspace()
@@ -57,9 +130,48 @@ class DXFProcessor:
         dxf_directory = os.path.join(self.data['cwd'], "blender_files")
         dxf_path = os.path.join(dxf_directory, str(self.data['sku']) + '.dxf')
         if not os.path.exists(dxf_directory): os.makedirs(dxf_directory)
+
+        save_start = time.time()
+        if self.data.get('dxf_mode') == 'compact':
+            self.compact(self.data.get('dxf_precision', 4))
         self.doc.saveas(dxf_path, encoding='utf-8')
+        print(f"DXF {os.path.basename(dxf_path)}: {os.path.getsize(dxf_path)} bytes saved in {time.time() - save_start} seconds")
+
+        if str(self.data.get('dxf_binary')).lower() in ('1', 'true'):
+            binary_path = os.path.join(dxf_directory, str(self.data['sku']) + '_binary.dxf')
+            self.doc.saveas(binary_path, fmt='bin')
+            self.data['dxf_archive_file'] = binary_path
         return dxf_path
 
+    def get_geometry_hash(self):
+        digest = hashlib.sha256()
+        digest.update(f"{self.data.get('dxf_mode')}:{self.data.get('dxf_precision')}".encode('utf-8'))
+        for entity in self.msp.query('CIRCLE'):
+            digest.update(entity.dxf.layer.encode('utf-8'))
+            digest.update(np.array([*entity.dxf.center, entity.dxf.radius], dtype=np.float64).tobytes())
+        digest.update(self.contours.to_bytes())
+        return digest.hexdigest()
+
+    def compact(self, precision: int):
+        for entity in self.msp.query('CIRCLE'):
+            entity.dxf.center = (round(entity.dxf.center.x, precision), round(entity.dxf.center.y, precision))
+            entity.dxf.radius = round(entity.dxf.radius, precision)
+
+        for name in list(self.doc.header.varnames()):
+            if name not in self.compact_header:
+                del self.doc.header[name]
+
+        used_layers = {entity.dxf.layer for entity in self.msp}
+        for layer in list(self.doc.layers):
+            if layer.dxf.name != '0' and layer.dxf.name not in used_layers:
+                self.doc.layers.remove(layer.dxf.name)
+
+        for table_name, required in self.compact_tables.items():
+            table = getattr(self.doc, table_name)
+            for entry in list(table):
+                if entry.dxf.name not in required:
+                    table.remove(entry.dxf.name)
+
     def get_body(self):
         layer_name = 'body'
         self.add_layer(layer_name)
@@ -101,22 +213,42 @@ class DXFProcessor:
         layer_name = 'engraving'
         dxfattribs = {'layer': layer_name, 'flags': 1}
         self.add_layer(layer_name)
-        elements = []
-    
-        for contour in ImageProcessor.process_image(self.data.get("image_url"), target='dxf'):
-            transformed_contour = [(y, -x) for x, y in contour]
-            element = self.msp.add_lwpolyline(transformed_contour, dxfattribs=dxfattribs, close=True)
-            elements.append(element)
-    
-        self.fit_engraving(elements)
-        return elements
 
-    def fit_engraving(self, engraving: list):
-        max_square = self.get_max_square()
-        handles_bbox = self.get_handle_bbox()
-        max_rect = self.get_max_rect(max_square, handles_bbox)
-        engraving_bbox = self.get_engraving_bbox(engraving)
-        scaled = self.scale_engraving(engraving, max_rect, engraving_bbox)
+        self.contours = ImageProcessor.process_image(self.data.get("image_url"), target='dxf').transform([[0, 1, 0], [-1, 0, 0]])
+        if len(self.contours): self.contours = self.cull_engraving(self.contours)
+        if not len(self.contours):
+            self.data['engraving_depths'] = []
+            return []
+
+        depths = ImageProcessor.get_depths(self.contours)
+        order = np.argsort(depths, kind='stable')
+        self.data['engraving_depths'] = depths[order].tolist()
+        self.contours = self.fit_engraving(self.contours[order])
+
+        # float32 coordinates are rounded so their float64 repr stays short in the DXF
+        precision = self.data.get('dxf_precision', 4) if self.data.get('dxf_mode') == 'compact' else 6
+        return [self.msp.add_lwpolyline(np.round(contour.astype(np.float64), precision), dxfattribs=dxfattribs, close=True)
+                for contour in self.contours]
+
+    def cull_engraving(self, contours: ContourSet):
+        # the scale before culling is a lower bound of the final fit scale
+        max_rect = self.get_max_rect(self.get_max_square(), self.get_handle_bbox())
+        scale = self.get_fit_scale(max_rect, contours.get_bbox())
+        min_area = self.data.get('min_area', 0.02) / scale ** 2
+        min_feature = self.data.get('min_feature', 0.15) / scale
+        keep = ImageProcessor.get_significant(contours, min_area, min_feature)
+        print(f"Culled {int(np.sum(~keep))} of {len(contours)} engraving contours")
+        return contours[keep]
+
+    def fit_engraving(self, contours: ContourSet):
+        max_rect = self.get_max_rect(self.get_max_square(), self.get_handle_bbox())
+        engraving_bbox = contours.get_bbox()
+        scale = self.get_fit_scale(max_rect, engraving_bbox)
+
+        translation_x = (max_rect[2] + max_rect[0]) / 2 - ((engraving_bbox[2] + engraving_bbox[0]) / 2) * scale
+        translation_y = (max_rect[3] + max_rect[1]) / 2 - ((engraving_bbox[3] + engraving_bbox[1]) / 2) * scale
+
+        return contours.transform([[scale, 0, translation_x], [0, scale, translation_y]])
 
     def get_max_square(self):
         square_side_length = self.body.dxf.radius * math.sqrt(2)
@@ -127,18 +259,6 @@ class DXFProcessor:
 
         return bounding_box
 
-    def get_engraving_bbox(self, elements):
-        min_x, min_y = float('inf'), float('inf')
-        max_x, max_y = float('-inf'), float('-inf')
-
-        for element in elements:
-            if hasattr(element, 'vertices') and callable(element.vertices):
-                for point in element.vertices():
-                    min_x, min_y = min(min_x, point[0]), min(min_y, point[1])
-                    max_x, max_y = max(max_x, point[0]), max(max_y, point[1])
-
-        return (min_x, min_y, max_x, max_y)
-    
     def get_handle_bbox(self):
         min_x, min_y = float('inf'), float('inf')
         max_x, max_y = float('-inf'), float('-inf')
@@ -170,23 +290,10 @@ class DXFProcessor:
 
         return (min_x, min_y, max_x, max_y)
     
-    def scale_engraving(self, elements, max_rect, engraving_bbox):
+    def get_fit_scale(self, max_rect, engraving_bbox):
         scale_x = (max_rect[2] - max_rect[0]) / (engraving_bbox[2] - engraving_bbox[0])
         scale_y = (max_rect[3] - max_rect[1]) / (engraving_bbox[3] - engraving_bbox[1])
-        scale = 0.95 * min(scale_x, scale_y)
-    
-        center_max_rect_x = (max_rect[2] + max_rect[0]) / 2
-        center_max_rect_y = (max_rect[3] + max_rect[1]) / 2
-    
-        center_engraving_scaled_x = ((engraving_bbox[2] + engraving_bbox[0]) / 2) * scale
-        center_engraving_scaled_y = ((engraving_bbox[3] + engraving_bbox[1]) / 2) * scale
-    
-        translation_x = center_max_rect_x - center_engraving_scaled_x
-        translation_y = center_max_rect_y - center_engraving_scaled_y
-    
-        for element in elements:
-            element.transform(Matrix44.scale(scale, scale, 0))
-            element.transform(Matrix44.translate(translation_x, translation_y, 0))
+        return 0.95 * min(scale_x, scale_y)
 
     def add_layer(self, layer_name: str):
         if layer_name not in self.doc.layers:
@@ -0,0 +1,127 @@
+import os, json, hashlib, time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class SingleFlightError(RuntimeError):
+    pass
+
+
+class SingleFlight:
+    def __init__(self, directory: str, max_age: float = 600):
+        self.directory = directory
+        self.max_age   = max_age
+        if not os.path.exists(directory): os.makedirs(directory)
+
+    @staticmethod
+    def get_key(data: dict, fields: tuple) -> str:
+        canonical = json.dumps({field: str(data.get(field)) for field in fields}, sort_keys=True)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def run(self, key: str, func):
+        if fcntl is None:
+            return func()
+
+        lock_path = os.path.join(self.directory, f"{key}.lock")
+        started = time.time()
+        while True:
+            lock_file = open(lock_path, 'a+')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                waited = False
+            except BlockingIOError:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                waited = True
+            if self.is_current(lock_file, lock_path):
+                break
+            lock_file.close()
+
+        try:
+            if waited:
+                entry = self.read_entry(key, started)
+                if entry is not None:
+                    self.increment_coalesced()
+                    if 'error' in entry:
+                        raise SingleFlightError(f"Coalesced job failed: {entry['error']}")
+                    return entry['result']
+            self.write_entry(key, {'running': time.time()})
+            try:
+                result = func()
+            except BaseException as e:
+                self.write_entry(key, {'finished': time.time(), 'error': f"{type(e).__name__}: {e}"})
+                raise
+            self.write_entry(key, {'finished': time.time(), 'result': result})
+            return result
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+            self.cleanup()
+
+    @staticmethod
+    def is_current(lock_file, lock_path: str) -> bool:
+        try:
+            return os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def read_entry(self, key: str, not_before: float):
+        result_path = os.path.join(self.directory, f"{key}.json")
+        if not os.path.exists(result_path):
+            return None
+        with open(result_path, 'r') as f:
+            entry = json.load(f)
+        if 'finished' in entry:
+            return entry if entry['finished'] >= not_before else None
+        # the previous leader died without recording an outcome while this request waited
+        if not_before - entry['running'] < self.max_age:
+            return {'error': "the job was interrupted before it finished"}
+        return None
+
+    def write_entry(self, key: str, entry: dict) -> None:
+        result_path = os.path.join(self.directory, f"{key}.json")
+        temp_path = f"{result_path}.{os.getpid()}"
+        with open(temp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(temp_path, result_path)
+
+    def cleanup(self) -> None:
+        expired = time.time() - self.max_age
+        for name in os.listdir(self.directory):
+            if not name.endswith('.lock'):
+                continue
+            lock_path = os.path.join(self.directory, name)
+            result_path = os.path.join(self.directory, f"{name[:-len('.lock')]}.json")
+            try:
+                if os.path.getmtime(lock_path) > expired or (os.path.exists(result_path) and os.path.getmtime(result_path) > expired):
+                    continue
+            except FileNotFoundError:
+                continue
+            with open(lock_path, 'a+') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                if self.is_current(lock_file, lock_path):
+                    if os.path.exists(result_path): os.remove(result_path)
+                    os.remove(lock_path)
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def increment_coalesced(self) -> None:
+        with open(os.path.join(self.directory, 'coalesced'), 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            count = int(f.read() or 0) + 1
+            f.seek(0)
+            f.truncate()
+            f.write(str(count))
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get_coalesced(self) -> int:
+        counter_path = os.path.join(self.directory, 'coalesced')
+        if not os.path.exists(counter_path):
+            return 0
+        with open(counter_path, 'r') as f:
+            return int(f.read() or 0)
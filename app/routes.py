@@ -1,4 +1,4 @@
-from flask import request, send_file
+from flask import request, send_file, jsonify
 from app import app
 from app.controllers import Controller
 import os
@@ -13,10 +13,22 @@ def hello():
         'sku': '123456',
         'obj_type': 'necklace',
         'obj_size': 12,
-        'from_svg': 'bone'
+        'from_svg': 'bone',
+        'resolution_x': 1920,
+        'resolution_y': 1080,
+        'image_format': 'PNG',
+        'image_quality': 90,
+        'render_padding': 0.05,
+        'views': '',
+        'dxf_mode': 'full',
+        'dxf_precision': 4,
+        'dxf_binary': '',
+        'min_area': 0.02,
+        'min_feature': 0.15
     }
     
     data = {field: request.form.get(field, default) for field, default in expected_fields.items()}
+    data['profile'] = str(request.form.get('profile') or request.headers.get('X-Profile', '')).lower() in ('1', 'true')
     controller = Controller(data)
     response = send_file(controller.get_archive())
 
@@ -32,4 +44,9 @@ def register_shape():
     controller = Controller(data)
     response = controller.create_svg()
 
-    return response
\ No newline at end of file
+    return response
+
+@app.route('/coalesced', methods=['GET'])
+def coalesced():
+    controller = Controller({})
+    return jsonify({'coalesced': controller.get_coalesced()})
\ No newline at end of file
@@ -1,7 +1,8 @@
 import bpy, random, math, bmesh, os, time
-from mathutils import Vector
+from mathutils import Vector, Matrix
+from bpy_extras.object_utils import world_to_camera_view
 from typing import Optional
-import json
+import json, cProfile
 
 time_start = time.time()
 
@@ -35,6 +36,51 @@ class Config:
         bpy.context.scene.cycles.samples         = 100
         bpy.context.scene.cycles.preview_samples = 50
 
+    @staticmethod
+    def set_output_settings(data: dict) -> None:
+        render                            = bpy.context.scene.render
+        render.resolution_x               = int(data.get("resolution_x", 1920))
+        render.resolution_y               = int(data.get("resolution_y", 1080))
+        render.resolution_percentage      = 100
+        render.image_settings.file_format = data.get("image_format", "PNG")
+
+        if render.image_settings.file_format in ("JPEG", "WEBP"):
+            render.image_settings.color_mode = "RGB"
+            render.image_settings.quality    = int(data.get("image_quality", 90))
+
+    @staticmethod
+    def get_render_bounds(objects: list) -> Optional[tuple]:
+        scene     = bpy.context.scene
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        xs, ys    = [], []
+
+        for obj in objects:
+            evaluated = obj.evaluated_get(depsgraph)
+            for corner in evaluated.bound_box:
+                co = world_to_camera_view(scene, scene.camera, evaluated.matrix_world @ Vector(corner))
+                if co.z > 0:
+                    xs.append(co.x)
+                    ys.append(co.y)
+
+        if not xs:
+            return None
+        return min(xs), min(ys), max(xs), max(ys)
+
+    @staticmethod
+    def set_render_region(bounds: Optional[tuple], padding: float) -> None:
+        scene = bpy.context.scene
+        if bounds is None:
+            scene.render.use_border = False
+            return
+
+        min_x, min_y, max_x, max_y      = bounds
+        scene.render.use_border         = True
+        scene.render.use_crop_to_border = True
+        scene.render.border_min_x       = max(0.0, min_x - padding)
+        scene.render.border_max_x       = min(1.0, max_x + padding)
+        scene.render.border_min_y       = max(0.0, min_y - padding)
+        scene.render.border_max_y       = min(1.0, max_y + padding)
+
     @staticmethod
     def set_camera_settings() -> None:
         bpy.ops.object.camera_add(enter_editmode=False, align="VIEW", location=(60, 0, 0))
@@ -43,6 +89,12 @@ class Config:
         bpy.context.scene.camera = camera
         ObjectManipulator.point_object_to_position(camera, (0, 0, 0))
 
+    @staticmethod
+    def set_camera_pose(elevation: float, distance: float) -> None:
+        camera          = bpy.context.scene.camera
+        camera.location = (distance * math.cos(math.radians(elevation)), 0, distance * math.sin(math.radians(elevation)))
+        ObjectManipulator.point_object_to_position(camera, (0, 0, 0))
+
     @staticmethod
     def set_world_settings() -> None:
         bpy.context.scene.world.use_nodes = True
@@ -314,15 +366,19 @@ class ObjectManipulator:
     def add_holes(self, body: bpy.types.Object, holes: bpy.types.Object) -> bool:
         try:
             self.apply_boolean_modifier(body, holes, vertex_group_name="holes", incl_z=True)
+            return True
         except Exception as e:
             print(f"Error while adding holes: {e}")
+            return False
 
     def apply_engraving(self, body: bpy.types.Object, engraving: bpy.types.Object) -> bool:
         try:
             self.apply_boolean_modifier(body, engraving, vertex_group_name="engraving")
             self.delete_object(engraving)
+            return True
         except Exception as e:
             print(f"Error while applying engraving: {e}")
+            return False
 
     def add_chain_comp(self, hole: bpy.types.Object, body: bpy.types.Object) -> None:
         chain_link = self.create_chain_link(hole, body)
@@ -462,6 +518,10 @@ class ObjectManipulator:
         object.rotation_euler[1] = math.radians(ry)
         object.rotation_euler[2] = math.radians(rz)
 
+    @staticmethod
+    def spin_object(obj: bpy.types.Object, base_matrix: Matrix, degrees: float) -> None:
+        obj.matrix_world = Matrix.Rotation(math.radians(degrees), 4, "Z") @ base_matrix
+
     @staticmethod
     def point_object_to_position(obj: bpy.types.Object, target_position: Optional[Vector]):
         if not isinstance(target_position, Vector):
@@ -476,39 +536,94 @@ class BlenderWorker:
         self.data               = self.load_data()
         self.object_manipulator = ObjectManipulator()
         self.config             = Config()
-        self.main()
+        self.random             = random.Random(self.data.get("geometry_hash"))
+        if self.data.get("profile"):
+            self.profile_main()
+        else:
+            self.main()
 
     def main(self):
-        self.import_objects()
-        self.modify_objects()
+        if not self.load_mesh_cache():
+            self.import_objects()
+            booleans_applied = self.modify_objects()
+            MaterialManager().set_materials(self.get_objects()[0])
+            self.remove_cutters()
+            if booleans_applied:
+                self.save_mesh_cache()
+            else:
+                print("Skipping mesh cache because a boolean failed")
         self.finalize_objects()
         self.render_image()
         print(f"Blender process completed in {time.time() - time_start} seconds")
 
+    def profile_main(self):
+        render_stats = []
+        bpy.app.handlers.render_stats.append(lambda stats, *args: render_stats.append(stats))
+        profiler = cProfile.Profile()
+        profiler.runcall(self.main)
+        profiler.dump_stats(self.data.get("blender_profile"))
+        with open(self.data.get("render_stats"), "w") as f:
+            f.write("\n".join(render_stats))
+
     def modify_objects(self):
         body, holes, engraving = self.get_objects()
         self.apply_extrusions(body, holes, engraving)
-        self.apply_manipulations(body, holes, engraving)
+        return self.apply_manipulations(body, holes, engraving)
 
     def finalize_objects(self):
         body, holes, _ = self.get_objects()
         self.config.add_world_objects(body)
-        MaterialManager().set_materials(body)
         self.apply_configurations()
 
+    def load_mesh_cache(self) -> bool:
+        cache_path = self.data.get("mesh_cache")
+        if not cache_path or not os.path.exists(cache_path):
+            return False
+
+        with bpy.data.libraries.load(cache_path, link=False) as (data_from, data_to):
+            data_to.objects = data_from.objects
+        for obj in data_to.objects:
+            if obj is not None: bpy.context.scene.collection.objects.link(obj)
+        print(f"Loaded cached mesh {os.path.basename(cache_path)}")
+        return True
+
+    def remove_cutters(self) -> None:
+        body = self.get_objects()[0]
+        keep = {body, *body.children_recursive}
+        for obj in list(bpy.context.scene.objects):
+            if obj not in keep:
+                self.object_manipulator.delete_object(obj)
+
+    def save_mesh_cache(self) -> None:
+        cache_path = self.data.get("mesh_cache")
+        if not cache_path:
+            return
+
+        body = self.get_objects()[0]
+        temp_path = f"{cache_path}.{os.getpid()}.blend"
+        bpy.data.libraries.write(temp_path, {body, *body.children_recursive}, fake_user=True)
+        os.replace(temp_path, cache_path)
+
     def apply_extrusions(self, body, holes, engraving):
         self.extrude(body, height=0.8, bevel=True)
         self.extrude(holes, height=0.9)
-        self.extrude(engraving, height=0.25)
+        if engraving: self.extrude(engraving, height=0.25)
 
     def apply_manipulations(self, body, holes, engraving):
-        self.object_manipulator.add_holes(body, holes)
-        self.object_manipulator.apply_engraving(body, engraving)
+        depths        = self.data.get("engraving_depths", [])
+        boolean_start = time.time()
+        holes_added   = self.object_manipulator.add_holes(body, holes)
+        engraved      = self.object_manipulator.apply_engraving(body, engraving) if engraving else True
+        print(f"Booleans finished in {time.time() - boolean_start} seconds "
+              f"(holes: {holes_added}, engraving: {engraved}, "
+              f"outer contours: {sum(1 for depth in depths if depth % 2 == 0)}, "
+              f"hole contours: {sum(1 for depth in depths if depth % 2 == 1)})")
         self.object_manipulator.set_origin_to_geometry(holes)
         self.object_manipulator.set_origin_to_geometry(body)
         self.object_manipulator.add_chain_comp(holes, body)
         self.object_manipulator.move_object(body, 0, 0, 0)
         self.object_manipulator.rotate_object(body, 110, 0, -75)
+        return holes_added and engraved
 
     def apply_configurations(self):
         self.config.set_render_settings()
@@ -516,13 +631,51 @@ class BlenderWorker:
         self.config.set_world_settings()
 
     def render_image(self):
-        bpy.context.scene.render.filepath = self.data.get("output")
-        bpy.ops.render.render(write_still=True)
+        body, _, _     = self.get_objects()
+        base_matrix    = body.matrix_world.copy()
+        render_objects = self.get_render_objects(body)
+        padding        = float(self.data.get("render_padding", 0.05))
+        self.config.set_output_settings(self.data)
+        bpy.context.scene.render.use_persistent_data = True
+
+        views = self.data.get("views")
+        self.config.set_render_region(self.get_views_bounds(body, base_matrix, render_objects, views), padding)
+
+        for view, output in zip(views, self.data.get("outputs")):
+            self.set_view(body, base_matrix, view)
+            bpy.context.scene.render.filepath = output
+
+            render_start = time.time()
+            bpy.ops.render.render(write_still=True)
+            print(f"Rendered {os.path.getsize(output)} bytes in {time.time() - render_start} seconds")
+
+    def set_view(self, body: bpy.types.Object, base_matrix: Matrix, view: list) -> None:
+        azimuth, elevation, distance = view
+        self.object_manipulator.spin_object(body, base_matrix, azimuth)
+        self.config.set_camera_pose(elevation, distance)
+        bpy.context.view_layer.update()
+
+    def get_views_bounds(self, body: bpy.types.Object, base_matrix: Matrix, render_objects: list, views: list) -> Optional[tuple]:
+        bounds = []
+        for view in views:
+            self.set_view(body, base_matrix, view)
+            view_bounds = self.config.get_render_bounds(render_objects)
+            if view_bounds is not None: bounds.append(view_bounds)
+
+        if not bounds:
+            return None
+        return (min(b[0] for b in bounds), min(b[1] for b in bounds),
+                max(b[2] for b in bounds), max(b[3] for b in bounds))
+
+    def get_render_objects(self, body: bpy.types.Object) -> list:
+        return [obj for obj in [body, *body.children_recursive] if obj.type == "MESH"]
 
     def import_objects(self) -> bool:
         if not bpy.context.preferences.addons.get('io_import_dxf'):
             bpy.ops.preferences.addon_enable(module='io_import_dxf')
+        import_start = time.time()
         bpy.ops.import_scene.dxf(filepath = self.data.get('dxf_file'))
+        print(f"DXF imported in {time.time() - import_start} seconds")
         for obj in bpy.context.scene.objects:
             new = obj.name.split("_")[0].lower()
             obj.name = new
@@ -563,7 +716,7 @@ class BlenderWorker:
         
     def extrude(self, obj: bpy.types.Object, height: float, bevel: bool = False, subdivision: bool = False, fill: str = "") -> bool:
         self.extrude_object(obj, height, fill)
-        if bevel      : ObjectManipulator().add_bevel(obj, random.uniform(0.15, 0.25), random.randint(10, 20))
+        if bevel      : ObjectManipulator().add_bevel(obj, self.random.uniform(0.15, 0.25), self.random.randint(10, 20))
         if subdivision: ObjectManipulator().add_subdivision_surface(obj, 1, 1, "SIMPLE")
 
 BlenderWorker()
\ No newline at end of file
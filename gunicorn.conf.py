@@ -0,0 +1,37 @@
+import gc, os, time
+
+bind        = "0.0.0.0:8000"
+workers     = 4
+timeout     = 300
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    from app.controllers.image_processor import ImageProcessor
+    ImageProcessor.preload()
+    gc.freeze()
+
+
+def pre_fork(server, worker):
+    worker.fork_time = time.time()
+
+
+def post_worker_init(worker):
+    boot_time = time.time() - worker.fork_time
+    memory = {}
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty'):
+                    memory[name] = int(value.split()[0])
+    except (OSError, ValueError) as e:
+        worker.log.info(f"Worker {worker.pid} booted in {boot_time:.3f}s (preload={preload_app}, memory unavailable: {e})")
+        return
+    worker.log.info(
+        f"Worker {worker.pid} booted in {boot_time:.3f}s "
+        f"(preload={preload_app}, rss={memory.get('Rss')}kB, pss={memory.get('Pss')}kB, "
+        f"shared={memory.get('Shared_Clean', 0) + memory.get('Shared_Dirty', 0)}kB)"
+    )